@@ -1,13 +1,43 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, g
 from flask_cors import CORS
 import os
 import re
+import hmac
+import time
+import logging
 from dotenv import load_dotenv
 import google.generativeai as genai
 from rag_utils import (
     initialize_rag_database,
     retrieve_relevant_conversations,
-    augment_prompt_with_rag
+    augment_prompt_with_rag,
+    get_embedding_stats
+)
+from logging_utils import (
+    get_logger,
+    log_event,
+    set_log_level,
+    set_sample_rate,
+    get_logging_config,
+    text_fields,
+    truncate,
+    elapsed_ms
+)
+from scheduler_utils import (
+    model_scheduler,
+    request_options,
+    SchedulerOverloaded,
+    PRIORITY_CHAT,
+    PRIORITY_INIT
+)
+from profiling_utils import (
+    request_started,
+    request_finished,
+    capture_cpu_profile,
+    start_memory_tracing,
+    memory_snapshot_diff,
+    stop_memory_tracing,
+    memory_status
 )
 
 # --- Load Environment Variables ---
@@ -20,6 +50,13 @@ if not api_key:
 genai.configure(api_key=api_key)
 MODEL = "gemini-2.0-flash"
 
+# --- Debug Endpoints ---
+# Debug routes are disabled unless a token is configured
+DEBUG_TOKEN = os.getenv("DEBUG_TOKEN")
+
+# --- Logging ---
+logger = get_logger("app")
+
 # --- Flask Setup ---
 app = Flask(__name__)
 CORS(app, resources={r"/api/*": {"origins": "*"}})
@@ -78,6 +115,12 @@ SPECIALIST_PROMPTS = {
     """
 }
 
+# Sent instead of a model reply when the model call queue is too long
+BUSY_REPLY = (
+    "I'm still here with you, but I'm getting a lot of messages right now. "
+    "Could you give me a moment and send that again?"
+)
+
 
 # --- Active Session Storage ---
 active_chats = {}
@@ -88,7 +131,7 @@ def create_chat(chat_id: str, system_prompt: str, model_name: str):
     if chat_id in active_chats:
         return active_chats[chat_id]
 
-    print(f"<System: Creating chat session {chat_id}>")
+    log_event(logger, "chat.session_created", logging.DEBUG, chat_id=chat_id)
     model = genai.GenerativeModel(
         model_name=model_name,
         system_instruction=system_prompt
@@ -97,6 +140,37 @@ def create_chat(chat_id: str, system_prompt: str, model_name: str):
     active_chats[chat_id] = chat
     return chat
 
+def specialist_issue(chat_id):
+    """Return the specialist issue a chat session handles, or None for the nurse"""
+    if not chat_id or chat_id.endswith("_nurse"):
+        return None
+    return chat_id[len(CURRENT_USER_ID) + 1:]
+
+def session_key():
+    """Identify the client for fair scheduling of model calls"""
+    return request.headers.get("X-Session-Id") or request.remote_addr
+
+def send_to_model(chat_session, message, priority=PRIORITY_CHAT):
+    """Send a message through the shared model call scheduler and return the reply text"""
+    response = model_scheduler.call(
+        chat_session.send_message, message,
+        priority=priority, session_id=session_key(),
+        request_options=request_options()
+    )
+    return response.text.strip()
+
+@app.before_request
+def start_request_profiling():
+    # Debug endpoints are excluded so a capture does not profile itself
+    if not request.path.startswith("/debug/"):
+        g.profile = request_started()
+        g.profiled = True
+
+@app.teardown_request
+def finish_request_profiling(exc):
+    if g.pop("profiled", False):
+        request_finished(g.pop("profile", None))
+
 @app.route("/")
 def index():
     return "✅ Mental Health Chatbot backend is running!"
@@ -115,12 +189,16 @@ def init_chat():
         current_chat_id = nurse_chat_id
         nurse_chat = create_chat(nurse_chat_id, NURSE_PROMPT, MODEL)
 
-        intro_message = nurse_chat.send_message("Introduce yourself").text.strip()
-        print(f"[NURSE INTRODUCTION] {intro_message}")
+        intro_message = send_to_model(nurse_chat, "Introduce yourself", PRIORITY_INIT)
+        log_event(logger, "init.intro", chat_id=nurse_chat_id, **text_fields(intro_message, "intro"))
         last_introduction = intro_message  # Cache the new introduction
         return jsonify({"intro": intro_message})
+    except SchedulerOverloaded:
+        # Shed under load: answer immediately with the cached or fallback introduction
+        fallback = last_introduction if last_introduction is not None else "Nurse Gemini is ready."
+        return jsonify({"intro": fallback, "degraded": True})
     except Exception as e:
-        print(f"Error initializing chat: {e}")
+        log_event(logger, "init.error", logging.WARNING, error=truncate(e))
         # If it's a rate-limit error and we have a previous introduction, return that
         if "429" in str(e) and last_introduction:
             return jsonify({"intro": last_introduction})
@@ -137,7 +215,8 @@ def chat():
 
     data = request.get_json()
     user_message = data.get("message", "").strip()
-    print(f"<User Message> {user_message}")
+    start = time.perf_counter()
+    log_event(logger, "chat.request", **text_fields(user_message, "message"))
 
     try:
         if not active_chats:
@@ -152,15 +231,22 @@ def chat():
 
         # Step 2.1: RAG Enhancement - Get relevant conversations
         try:
-            relevant_examples = retrieve_relevant_conversations(user_message)
-            print("This happens")
+            # Specialists search only their issue's partition of the examples
+            relevant_examples = retrieve_relevant_conversations(
+                user_message,
+                issue=specialist_issue(current_chat_id)
+            )
             if relevant_examples:
                 # Augment prompt with relevant examples
                 augmented_prompt = augment_prompt_with_rag(
                     user_message,
                     relevant_examples
                 )
-                print(augmented_prompt) 
+                log_event(
+                    logger, "rag.augmented", logging.DEBUG,
+                    examples=len(relevant_examples),
+                    prompt_len=len(augmented_prompt)
+                )
                 # Use the augmented prompt instead
                 augmented_input = augmented_prompt
             # else:
@@ -168,11 +254,16 @@ def chat():
             #     # Fall back to original prompt if no relevant examples
             #     response = current_chat.send_message(user_message).text.strip()
         except Exception as rag_error:
-            print(f"RAG enhancement failed: {rag_error}. Using default prompt.")
+            log_event(logger, "rag.error", logging.WARNING, error=truncate(rag_error))
             # response = current_chat.send_message(user_message).text.strip()
 
-        response = current_chat.send_message(augmented_input).text.strip()
-        print(f"[{current_chat_id.upper()} RESPONSE] {response}")
+        response = send_to_model(current_chat, augmented_input)
+        log_event(
+            logger, "chat.response",
+            chat_id=current_chat_id,
+            latency_ms=elapsed_ms(start),
+            **text_fields(response, "response")
+        )
 
         # Step 2: Did Nurse Gemini say to hand over?
         if current_chat_id.endswith("_nurse") and response.startswith("HANDOVER:"):
@@ -187,15 +278,130 @@ def chat():
             # Send intro message to new specialist bot
             # handover_intro = f"The user was transferred for {issue}."
             # response = current_chat.send_message(handover_intro).text.strip()
-            response = current_chat.send_message(augmented_input).text.strip()
+            response = send_to_model(current_chat, augmented_input)
+            log_event(
+                logger, "chat.handover",
+                issue=truncate(issue, 40),
+                chat_id=current_chat_id,
+                latency_ms=elapsed_ms(start),
+                **text_fields(response, "response")
+            )
 
         return jsonify({'response': response})
 
+    except SchedulerOverloaded:
+        return jsonify({'response': BUSY_REPLY, 'degraded': True})
     except Exception as e:
-        print(f"<Error> {e}")
+        log_event(logger, "chat.error", logging.ERROR, error=truncate(e))
         return jsonify({'error': f'Server error: {str(e)}'}), 500
 
 
+def debug_authorized():
+    """Check the debug token sent with a request against DEBUG_TOKEN"""
+    if not DEBUG_TOKEN:
+        return False
+    return hmac.compare_digest(request.headers.get("X-Debug-Token", ""), DEBUG_TOKEN)
+
+
+@app.route("/debug/logging", methods=["GET", "POST"])
+def debug_logging():
+    """Inspect or change the log level and per-event sampling rates at runtime"""
+    if not debug_authorized():
+        return jsonify({'error': 'Not found'}), 404
+
+    if request.method == "POST":
+        data = request.get_json(silent=True) or {}
+        if not isinstance(data, dict):
+            return jsonify({'error': 'Invalid logging config: expected a JSON object'}), 400
+        sample_rates = data.get("sample_rates") or {}
+        if not isinstance(sample_rates, dict):
+            return jsonify({'error': 'Invalid logging config: "sample_rates" must be an object'}), 400
+        try:
+            if "level" in data:
+                set_log_level(data["level"], data.get("logger"))
+            for event, rate in sample_rates.items():
+                set_sample_rate(event, rate)
+        except (TypeError, ValueError) as e:
+            return jsonify({'error': f'Invalid logging config: {str(e)}'}), 400
+
+    return jsonify(get_logging_config())
+
+
+@app.route("/debug/embeddings", methods=["GET"])
+def debug_embeddings():
+    """Report how query embeddings are being batched"""
+    if not debug_authorized():
+        return jsonify({'error': 'Not found'}), 404
+    return jsonify(get_embedding_stats())
+
+
+@app.route("/debug/scheduler", methods=["GET"])
+def debug_scheduler():
+    """Report model call concurrency, queue lengths and shed counts"""
+    if not debug_authorized():
+        return jsonify({'error': 'Not found'}), 404
+    return jsonify(model_scheduler.stats())
+
+
+@app.route("/debug/profile", methods=["GET"])
+def debug_profile():
+    """Capture a time-boxed CPU profile of live request handling
+
+    Query parameters: seconds, interval_ms (sampling interval), limit (text rows) and
+    format: collapsed (flamegraph input), pstats (binary, load with pstats) or text.
+    """
+    if not debug_authorized():
+        return jsonify({'error': 'Not found'}), 404
+
+    try:
+        body, mimetype, info = capture_cpu_profile(
+            seconds=request.args.get("seconds", 10),
+            interval_ms=request.args.get("interval_ms", 5),
+            fmt=request.args.get("format", "collapsed"),
+            limit=request.args.get("limit", 50)
+        )
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except RuntimeError as e:
+        return jsonify({'error': str(e)}), 409
+
+    response = app.response_class(body, mimetype=mimetype)
+    # Coverage of the capture, e.g. X-Profile-Skipped-Requests for requests cProfile could not trace
+    for key, value in info.items():
+        response.headers[f"X-Profile-{key.replace('_', '-').title()}"] = str(value)
+    if mimetype == "application/octet-stream":
+        response.headers["Content-Disposition"] = "attachment; filename=profile.pstats"
+    return response
+
+
+@app.route("/debug/profile/memory", methods=["GET", "POST", "DELETE"])
+def debug_profile_memory():
+    """Start tracemalloc (POST), diff against the baseline snapshot (GET) or stop it (DELETE)"""
+    if not debug_authorized():
+        return jsonify({'error': 'Not found'}), 404
+
+    try:
+        if request.method == "POST":
+            result = start_memory_tracing(request.args.get("frames", 10))
+        elif request.method == "DELETE":
+            result = stop_memory_tracing()
+        elif request.args.get("diff", "1") == "0":
+            result = memory_status()
+        else:
+            result = memory_snapshot_diff(
+                limit=request.args.get("limit", 25),
+                reset=request.args.get("reset") == "1",
+                group_by=request.args.get("group_by", "traceback")
+            )
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except RuntimeError as e:
+        return jsonify({'error': str(e)}), 409
+
+    result["active_chats"] = len(active_chats)
+    return jsonify(result)
+
+
 if __name__ == '__main__':
     # Initialize RAG database before starting the app
     initialize_rag_database()
@@ -2,25 +2,66 @@
 ChromaDB implementation of the database provider
 """
 import os
+import json
+import logging
 import chromadb
 from db_provider import DatabaseProvider
+from logging_utils import get_logger, log_event
 from dotenv import load_dotenv
 
 # Load environment variables
 load_dotenv()
 CHROMADB_PATH = os.getenv("CHROMADB_PATH", "./chroma_db")
+CHROMADB_COLLECTION = "mental_health_conversations"
+# Optional HNSW settings, applied only when the collection is created
+CHROMA_HNSW_M = os.getenv("CHROMA_HNSW_M")
+CHROMA_HNSW_SEARCH_EF = os.getenv("CHROMA_HNSW_SEARCH_EF")
+CHROMA_HNSW_CONSTRUCTION_EF = os.getenv("CHROMA_HNSW_CONSTRUCTION_EF")
+
+logger = get_logger("chromadb")
+
+
+def hnsw_metadata(m=None, search_ef=None, construction_ef=None):
+    """Build ChromaDB collection metadata for the given HNSW parameters"""
+    metadata = {"hnsw:space": "cosine"}
+    if m:
+        metadata["hnsw:M"] = int(m)
+    if search_ef:
+        metadata["hnsw:search_ef"] = int(search_ef)
+    if construction_ef:
+        metadata["hnsw:construction_ef"] = int(construction_ef)
+    return metadata
+
+
+def issue_flag(issue):
+    """Metadata key marking a document as part of an issue partition"""
+    return f"issue_{issue}"
 
 
 class ChromaDBProvider(DatabaseProvider):
     """ChromaDB implementation of DatabaseProvider"""
 
-    def __init__(self):
+    def __init__(self, collection_name=CHROMADB_COLLECTION, hnsw_params=None, ephemeral=False):
         self.client = None
         self.collection = None
+        self.collection_name = collection_name
+        self.ephemeral = ephemeral
+        if hnsw_params is None:
+            hnsw_params = {
+                "m": CHROMA_HNSW_M,
+                "search_ef": CHROMA_HNSW_SEARCH_EF,
+                "construction_ef": CHROMA_HNSW_CONSTRUCTION_EF
+            }
+        self.collection_metadata = hnsw_metadata(**hnsw_params)
+        self._partition_counts = {}
 
     def initialize(self):
         """Initialize the ChromaDB client"""
-        self.client = chromadb.PersistentClient(CHROMADB_PATH)
+        if self.ephemeral:
+            # In-memory client, used by the offline evaluation tool
+            self.client = chromadb.EphemeralClient()
+        else:
+            self.client = chromadb.PersistentClient(CHROMADB_PATH)
         return self.client
 
     def get_collection(self):
@@ -30,13 +71,13 @@ class ChromaDBProvider(DatabaseProvider):
 
         try:
             # Try to get the collection first
-            self.collection = self.client.get_collection("mental_health_conversations")
-            print("Using existing ChromaDB collection")
+            self.collection = self.client.get_collection(self.collection_name)
+            log_event(logger, "chromadb.collection", logging.DEBUG, created=False)
         except:
-            print("Creating new ChromaDB collection")
+            log_event(logger, "chromadb.collection", created=True)
             self.collection = self.client.create_collection(
-                name="mental_health_conversations",
-                metadata={"hnsw:space": "cosine"}
+                name=self.collection_name,
+                metadata=self.collection_metadata
             )
         return self.collection
 
@@ -51,30 +92,91 @@ class ChromaDBProvider(DatabaseProvider):
         if not self.collection:
             self.get_collection()
 
+        # ChromaDB metadata values must be scalars, so the answer list is stored as JSON
+        stored_metadatas = []
+        for metadata in metadatas:
+            metadata = dict(metadata)
+            if "expert_responses" in metadata:
+                metadata["expert_responses"] = json.dumps(metadata["expert_responses"])
+            # Issue labels become boolean flags so searches can filter with `where`
+            for issue in metadata.pop("issues", []):
+                metadata[issue_flag(issue)] = True
+            stored_metadatas.append(metadata)
+
         self.collection.add(
             ids=ids,
             embeddings=embeddings,
-            metadatas=metadatas
+            metadatas=stored_metadatas
         )
+        self._partition_counts.clear()
 
-    def search_similar(self, query_embedding, top_k=3):
+    def search_similar(self, query_embedding, top_k=3, issue=None):
         """Search for similar documents using vector similarity"""
         if not self.collection:
             self.get_collection()
 
-        results = self.collection.query(
-            query_embeddings=[query_embedding],
-            n_results=top_k,
-            include=["metadatas"]
-        )
+        query = {
+            "query_embeddings": [query_embedding],
+            "n_results": top_k,
+            "include": ["metadatas"]
+        }
+        if issue:
+            query["where"] = {issue_flag(issue): True}
+        results = self.collection.query(**query)
 
         # Format the results to match the expected structure
         formatted_results = []
         if results and 'metadatas' in results and results['metadatas']:
-            for metadata in results['metadatas'][0]:  # First (and only) query results
+            # First (and only) query results
+            for doc_id, metadata in zip(results['ids'][0], results['metadatas'][0]):
                 formatted_results.append({
+                    "id": doc_id,
                     "user_input": metadata["user_input"],
-                    "expert_response": metadata["expert_response"]
+                    "expert_response": metadata["expert_response"],
+                    "expert_responses": json.loads(metadata.get("expert_responses") or "[]")
                 })
 
-        return formatted_results
\ No newline at end of file
+        return formatted_results
+
+    def partition_count(self, issue):
+        """Return the number of documents tagged with an issue"""
+        if not self.collection:
+            self.get_collection()
+
+        if issue not in self._partition_counts:
+            results = self.collection.get(where={issue_flag(issue): True}, include=[])
+            self._partition_counts[issue] = len(results["ids"])
+        return self._partition_counts[issue]
+
+    def get_all_embeddings(self):
+        """Return the ids, embedding vectors and metadata of every document in the collection"""
+        if not self.collection:
+            self.get_collection()
+
+        results = self.collection.get(include=["embeddings", "metadatas"])
+        return (
+            list(results["ids"]),
+            [list(e) for e in results["embeddings"]],
+            [self._decode_metadata(metadata) for metadata in results["metadatas"]]
+        )
+
+    @staticmethod
+    def _decode_metadata(metadata):
+        """Turn stored metadata back into the form passed to add_embeddings"""
+        decoded = {"issues": []}
+        for key, value in metadata.items():
+            if key.startswith("issue_"):
+                if value:
+                    decoded["issues"].append(key[len("issue_"):])
+            elif key == "expert_responses":
+                decoded[key] = json.loads(value or "[]")
+            else:
+                decoded[key] = value
+        return decoded
+
+    def delete_collection(self):
+        """Drop the collection (used to clean up evaluation collections)"""
+        if not self.client:
+            self.initialize()
+        self.client.delete_collection(self.collection_name)
+        self.collection = None
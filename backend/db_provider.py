@@ -34,8 +34,18 @@ class DatabaseProvider(ABC):
         pass
     
     @abstractmethod
-    def search_similar(self, query_embedding, top_k=3):
-        """Search for similar documents using vector similarity"""
+    def search_similar(self, query_embedding, top_k=3, issue=None):
+        """Search for similar documents using vector similarity, optionally only those tagged with issue"""
+        pass
+
+    @abstractmethod
+    def partition_count(self, issue):
+        """Return the number of documents tagged with an issue"""
+        pass
+
+    @abstractmethod
+    def get_all_embeddings(self):
+        """Return (ids, embeddings, metadatas) for every document in the collection"""
         pass
 
 
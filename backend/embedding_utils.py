@@ -0,0 +1,211 @@
+"""
+Micro-batching of concurrent embedding requests
+
+Requests that arrive within a short window (or until the batch is full) are sent
+to the embedding API as a single batched call, and each caller gets its own
+vector back. This keeps the number of API requests, and so quota usage, low
+under concurrent load. If a batch fails for a reason other than rate limiting,
+its texts are retried one by one so only the caller with the bad input fails.
+"""
+import os
+import math
+import time
+import queue
+import logging
+import threading
+from collections import Counter, deque
+from concurrent.futures import Future
+from dotenv import load_dotenv
+from logging_utils import get_logger, log_event, truncate
+from scheduler_utils import SchedulerOverloaded
+
+# Load environment variables
+load_dotenv()
+# How long the batcher waits for more requests after the first one arrives
+EMBED_BATCH_WINDOW_MS = float(os.getenv("EMBED_BATCH_WINDOW_MS", "20"))
+# Maximum number of texts sent in one embedding call
+EMBED_MAX_BATCH_SIZE = int(os.getenv("EMBED_MAX_BATCH_SIZE", "16"))
+# How long a caller waits for its embedding before giving up
+EMBED_BATCH_TIMEOUT_S = float(os.getenv("EMBED_BATCH_TIMEOUT_S", "30"))
+
+logger = get_logger("embedding")
+
+
+def percentile(values, q):
+    """Return the q-th percentile (0-100) of a list of numbers using nearest rank"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, math.ceil(q / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def summarize(values):
+    """Summarize a distribution as count, p50, p90, p99 and max"""
+    values = list(values)
+    return {
+        "count": len(values),
+        "p50": percentile(values, 50),
+        "p90": percentile(values, 90),
+        "p99": percentile(values, 99),
+        "max": max(values) if values else None,
+    }
+
+
+def affects_whole_batch(error):
+    """Whether an embedding error is about quota/load rather than one of the inputs"""
+    return isinstance(error, SchedulerOverloaded) or "429" in str(error)
+
+
+class EmbeddingBatcher:
+    """Collects embedding requests from many threads and embeds them in batches"""
+
+    def __init__(self, embed_fn, max_batch_size=EMBED_MAX_BATCH_SIZE,
+                 window_ms=EMBED_BATCH_WINDOW_MS, stats_window=1000):
+        # embed_fn takes a list of texts and returns a list of vectors in the same order
+        self.embed_fn = embed_fn
+        self.max_batch_size = max(1, max_batch_size)
+        self.window_s = max(0.0, window_ms) / 1000
+        self._queue = queue.Queue()
+        self._worker = None
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+
+        # Recent samples for reporting
+        self._batch_sizes = deque(maxlen=stats_window)
+        self._queue_delays_ms = deque(maxlen=stats_window)
+        self._call_latencies_ms = deque(maxlen=stats_window)
+        self._requests = 0
+        self._batches = 0
+        self._calls = 0
+        self._errors = 0
+
+    def _ensure_worker(self):
+        """Start the background worker thread on first use"""
+        if self._worker is not None and self._worker.is_alive():
+            return
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(
+                    target=self._run, name="embedding-batcher", daemon=True
+                )
+                self._worker.start()
+
+    def submit(self, text):
+        """Queue a text for embedding and return a Future for its vector"""
+        future = Future()
+        self._ensure_worker()
+        self._queue.put((text, time.perf_counter(), future))
+        return future
+
+    def embed(self, text, timeout=EMBED_BATCH_TIMEOUT_S):
+        """Embed a single text, blocking until its batch has been processed"""
+        return self.submit(text).result(timeout=timeout)
+
+    def _collect_batch(self):
+        """Block for the first request, then gather more until the window closes or the batch is full"""
+        batch = [self._queue.get()]
+        deadline = time.perf_counter() + self.window_s
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            try:
+                if remaining > 0:
+                    batch.append(self._queue.get(timeout=remaining))
+                else:
+                    # Window closed; still take anything that is already waiting
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        """Worker loop"""
+        while True:
+            batch = self._collect_batch()
+            self._process(batch)
+
+    def _process(self, batch):
+        """Embed one batch and hand each vector back to its caller"""
+        dispatched = time.perf_counter()
+        texts = [text for text, _, _ in batch]
+        queue_delays = [(dispatched - enqueued) * 1000 for _, enqueued, _ in batch]
+
+        calls = 1
+        try:
+            embeddings = self._embed(texts)
+        except Exception as e:
+            with self._stats_lock:
+                self._errors += 1
+            log_event(logger, "embedding.batch_error", logging.WARNING,
+                      size=len(batch), error=truncate(e))
+            if len(batch) > 1 and not affects_whole_batch(e):
+                # One bad input (e.g. over the token limit) must not fail the other callers
+                calls += self._process_individually(batch)
+            else:
+                for _, _, future in batch:
+                    future.set_exception(e)
+        else:
+            for (_, _, future), embedding in zip(batch, embeddings):
+                future.set_result(embedding)
+
+        latency_ms = (time.perf_counter() - dispatched) * 1000
+        with self._stats_lock:
+            self._requests += len(batch)
+            self._batches += 1
+            self._calls += calls
+            self._batch_sizes.append(len(batch))
+            self._queue_delays_ms.extend(queue_delays)
+            self._call_latencies_ms.append(latency_ms)
+        log_event(logger, "embedding.batch", logging.DEBUG,
+                  size=len(batch),
+                  queue_delay_ms=round(max(queue_delays), 1),
+                  latency_ms=round(latency_ms, 1))
+
+    def _embed(self, texts):
+        """Call embed_fn and check that one vector came back per text"""
+        embeddings = self.embed_fn(texts)
+        if embeddings is None or len(embeddings) != len(texts):
+            raise ValueError(
+                f"Embedding call returned {0 if embeddings is None else len(embeddings)} "
+                f"vectors for {len(texts)} texts"
+            )
+        return embeddings
+
+    def _process_individually(self, batch):
+        """Embed each text of a failed batch on its own; returns the number of calls made"""
+        calls = 0
+        for index, (text, _, future) in enumerate(batch):
+            calls += 1
+            try:
+                future.set_result(self._embed([text])[0])
+            except Exception as e:
+                future.set_exception(e)
+                if affects_whole_batch(e):
+                    # Rate limited or shed: the remaining texts would fail the same way
+                    for _, _, remaining in batch[index + 1:]:
+                        remaining.set_exception(e)
+                    break
+        return calls
+
+    def stats(self):
+        """Report batch-size and queueing-delay distributions over recent batches"""
+        with self._stats_lock:
+            requests, batches, calls, errors = self._requests, self._batches, self._calls, self._errors
+            batch_sizes = list(self._batch_sizes)
+            queue_delays = [round(v, 1) for v in self._queue_delays_ms]
+            call_latencies = [round(v, 1) for v in self._call_latencies_ms]
+
+        return {
+            "requests": requests,
+            "batches": batches,
+            "calls": calls,
+            "errors": errors,
+            "calls_saved": requests - calls,
+            "pending": self._queue.qsize(),
+            "max_batch_size": self.max_batch_size,
+            "window_ms": self.window_s * 1000,
+            "batch_size": dict(summarize(batch_sizes),
+                               histogram=dict(sorted(Counter(batch_sizes).items()))),
+            "queue_delay_ms": summarize(queue_delays),
+            "call_latency_ms": summarize(call_latencies),
+        }
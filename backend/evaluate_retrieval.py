@@ -0,0 +1,305 @@
+"""
+Offline evaluation of retrieval quality and latency
+
+Runs a held-out set of questions from the counseling dataset against each
+database provider and reports recall@k against exact brute-force cosine
+neighbours, together with p50/p99 search latency, across a sweep of top_k and
+the provider's ANN parameters:
+
+- MongoDB: numCandidates of $vectorSearch (run against the live Atlas index)
+- ChromaDB: HNSW M and search ef (run on in-memory copies of the stored vectors)
+
+Searches are evaluated on the full index and on each specialist issue
+partition (questions tagged with that issue, searched with the issue filter).
+Providers that are not set up (e.g. no MONGODB_URI) are skipped.
+
+Usage (from the backend directory, after the database has been populated):
+    python evaluate_retrieval.py --queries 50 --top-k 1,3,5,10
+    python evaluate_retrieval.py --providers mongodb --num-candidates 20,50,100,200
+    python evaluate_retrieval.py --m 8,16,32 --ef 10,50,100 --issues none --output results.json
+"""
+import json
+import time
+import random
+import argparse
+import numpy as np
+from rag_utils import (
+    embed_texts,
+    load_and_process_dataset,
+    normalize_context,
+    tag_issues,
+    ISSUE_KEYWORDS
+)
+from embedding_utils import percentile
+
+# Maximum number of texts per embedding call
+EMBED_CHUNK_SIZE = 100
+PROVIDERS = ("chromadb", "mongodb")
+
+
+def parse_int_list(value):
+    """Parse a comma separated list of integers"""
+    return [int(v) for v in value.split(",") if v.strip()]
+
+
+def parse_name_list(value):
+    """Parse a comma separated list of names; "none" gives an empty list"""
+    names = [v.strip().lower() for v in value.split(",") if v.strip()]
+    return [] if names == ["none"] else names
+
+
+def create_provider(name):
+    """Create a database provider by name"""
+    if name == "mongodb":
+        from mongodb_utils import MongoDBProvider
+        return MongoDBProvider()
+    from chromadb_utils import ChromaDBProvider
+    return ChromaDBProvider()
+
+
+def load_corpus(provider):
+    """Return (ids, embeddings, metadatas) stored by a provider, skipping failed embeddings"""
+    ids, embeddings, metadatas = provider.get_all_embeddings()
+    stored = [i for i, embedding in enumerate(embeddings) if embedding is not None]
+    return (
+        [ids[i] for i in stored],
+        [embeddings[i] for i in stored],
+        [metadatas[i] for i in stored]
+    )
+
+
+def normalize_rows(matrix):
+    """Scale each row to unit length so dot products are cosine similarities"""
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def select_held_out_queries(dataset, indexed_contexts, count, seed):
+    """Pick distinct dataset questions whose normalized text is not stored in any index"""
+    candidates = {}
+    for item in dataset["train"]:
+        key = normalize_context(item["Context"])
+        if key and key not in indexed_contexts:
+            candidates.setdefault(key, item["Context"])
+    questions = [candidates[key] for key in sorted(candidates)]
+    random.Random(seed).shuffle(questions)
+    return questions[:count]
+
+
+def embed_queries(queries, pause=1.0):
+    """Embed the query texts in chunks"""
+    embeddings = []
+    for start in range(0, len(queries), EMBED_CHUNK_SIZE):
+        if start:
+            time.sleep(pause)
+        embeddings.extend(embed_texts(queries[start:start + EMBED_CHUNK_SIZE]))
+    return embeddings
+
+
+def exact_neighbours(query_matrix, corpus_matrix, corpus_ids, k):
+    """Return the ids of the k nearest corpus vectors for each query by brute force"""
+    scores = normalize_rows(query_matrix) @ normalize_rows(corpus_matrix).T
+    top = np.argsort(-scores, axis=1)[:, :k]
+    return [[corpus_ids[i] for i in row] for row in top]
+
+
+def result_id(result):
+    """Return the document id of a search result"""
+    return str(result.get("id", result.get("_id")))
+
+
+def run_searches(provider, query_embeddings, exact, top_k, issue=None):
+    """Search every query once and return (mean recall@k, latencies in ms)"""
+    # Warm up caches and connections before timing
+    provider.search_similar(query_embeddings[0], top_k, issue=issue)
+
+    recalls = []
+    latencies = []
+    for embedding, truth in zip(query_embeddings, exact):
+        start = time.perf_counter()
+        results = provider.search_similar(embedding, top_k, issue=issue)
+        latencies.append((time.perf_counter() - start) * 1000)
+
+        expected = {str(doc_id) for doc_id in truth[:top_k]}
+        found = {result_id(r) for r in results[:top_k]}
+        recalls.append(len(expected & found) / len(expected))
+    return float(np.mean(recalls)), latencies
+
+
+def report_row(provider_name, issue, params, top_k, recall, latencies):
+    """Build one row of the report"""
+    return dict(
+        provider=provider_name,
+        issue=issue or "all",
+        top_k=top_k,
+        **params,
+        recall=round(recall, 4),
+        p50_ms=round(percentile(latencies, 50), 2),
+        p99_ms=round(percentile(latencies, 99), 2),
+    )
+
+
+def sweep_mongodb(provider, query_embeddings, exact, issue, top_ks, num_candidates_list):
+    """Sweep top_k and numCandidates against the live MongoDB Atlas index"""
+    rows = []
+    original = provider.num_candidates
+    try:
+        for num_candidates in num_candidates_list:
+            provider.num_candidates = num_candidates
+            for top_k in top_ks:
+                if num_candidates < top_k:
+                    continue
+                recall, latencies = run_searches(provider, query_embeddings, exact, top_k, issue)
+                rows.append(report_row("mongodb", issue, {"num_candidates": num_candidates},
+                                       top_k, recall, latencies))
+    finally:
+        provider.num_candidates = original
+    return rows
+
+
+def sweep_chromadb(corpus, query_embeddings, exact, issue, top_ks, ms, efs):
+    """Sweep top_k and HNSW M/ef on in-memory copies of the stored vectors"""
+    from chromadb_utils import ChromaDBProvider
+
+    corpus_ids, corpus_embeddings, corpus_metadatas = corpus
+    rows = []
+    for m in ms:
+        for ef in efs:
+            provider = ChromaDBProvider(
+                collection_name=f"eval_m{m}_ef{ef}",
+                hnsw_params={"m": m, "search_ef": ef},
+                ephemeral=True
+            )
+            provider.get_collection()
+            # Only ids and issue tags are needed, but search results expect these fields
+            metadatas = [
+                {"user_input": "", "expert_response": "", "issues": metadata.get("issues", [])}
+                for metadata in corpus_metadatas
+            ]
+            for start in range(0, len(corpus_ids), 1000):
+                provider.add_embeddings(
+                    [str(doc_id) for doc_id in corpus_ids[start:start + 1000]],
+                    corpus_embeddings[start:start + 1000],
+                    metadatas[start:start + 1000]
+                )
+            try:
+                for top_k in top_ks:
+                    recall, latencies = run_searches(provider, query_embeddings, exact, top_k, issue)
+                    rows.append(report_row("chromadb", issue, {"m": m, "ef": ef},
+                                           top_k, recall, latencies))
+            finally:
+                provider.delete_collection()
+    return rows
+
+
+def evaluate_provider(name, provider, corpus, queries, query_embeddings, args):
+    """Evaluate one provider on the full index and on each issue partition"""
+    corpus_ids, corpus_embeddings, corpus_metadatas = corpus
+    corpus_matrix = np.asarray(corpus_embeddings, dtype=np.float32)
+    query_issues = [tag_issues(query) for query in queries]
+
+    rows = []
+    for issue in [None] + args.issues:
+        if issue is None:
+            doc_indexes = list(range(len(corpus_ids)))
+            query_indexes = list(range(len(queries)))
+        else:
+            # A specialist only sees questions about its issue and searches only its partition
+            doc_indexes = [i for i, m in enumerate(corpus_metadatas) if issue in m.get("issues", [])]
+            query_indexes = [i for i, tags in enumerate(query_issues) if issue in tags]
+        if len(doc_indexes) < max(args.top_k) or not query_indexes:
+            print(f"Skipping {name} partition '{issue}': "
+                  f"{len(doc_indexes)} documents, {len(query_indexes)} queries")
+            continue
+
+        partition_embeddings = [query_embeddings[i] for i in query_indexes]
+        exact = exact_neighbours(
+            np.asarray(partition_embeddings, dtype=np.float32),
+            corpus_matrix[doc_indexes],
+            [corpus_ids[i] for i in doc_indexes],
+            max(args.top_k)
+        )
+
+        if name == "mongodb":
+            rows.extend(sweep_mongodb(provider, partition_embeddings, exact, issue,
+                                      args.top_k, args.num_candidates))
+        else:
+            rows.extend(sweep_chromadb(corpus, partition_embeddings, exact, issue,
+                                       args.top_k, args.m, args.ef))
+    return rows
+
+
+def print_report(rows):
+    """Print the results as an aligned table"""
+    if not rows:
+        print("No results")
+        return
+    columns = []
+    for row in rows:
+        columns.extend(c for c in row if c not in columns)
+    widths = {c: max(len(c), *(len(str(r.get(c, ""))) for r in rows)) for c in columns}
+    print("  ".join(c.rjust(widths[c]) for c in columns))
+    for row in rows:
+        print("  ".join(str(row.get(c, "")).rjust(widths[c]) for c in columns))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Evaluate retrieval recall and latency")
+    parser.add_argument("--providers", type=parse_name_list, default=list(PROVIDERS),
+                        help="comma separated providers to evaluate")
+    parser.add_argument("--issues", type=parse_name_list, default=list(ISSUE_KEYWORDS),
+                        help="issue partitions to evaluate besides the full index ('none' for none)")
+    parser.add_argument("--queries", type=int, default=50, help="number of held-out queries")
+    parser.add_argument("--seed", type=int, default=0, help="random seed for query selection")
+    parser.add_argument("--top-k", type=parse_int_list, default=[1, 3, 5, 10])
+    parser.add_argument("--num-candidates", type=parse_int_list, default=[10, 20, 50, 100, 200],
+                        help="MongoDB numCandidates values")
+    parser.add_argument("--m", type=parse_int_list, default=[8, 16, 32], help="ChromaDB HNSW M values")
+    parser.add_argument("--ef", type=parse_int_list, default=[10, 50, 100], help="ChromaDB HNSW search ef values")
+    parser.add_argument("--output", help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    corpora = {}
+    for name in args.providers:
+        if name not in PROVIDERS:
+            raise SystemExit(f"Unknown provider '{name}', expected one of {', '.join(PROVIDERS)}")
+        provider = create_provider(name)
+        try:
+            corpus = load_corpus(provider)
+        except Exception as e:
+            print(f"Skipping {name}: {e}")
+            continue
+        if not corpus[0]:
+            print(f"Skipping {name}: the vector database is empty")
+            continue
+        corpora[name] = (provider, corpus)
+    if not corpora:
+        raise SystemExit("No populated vector database found; run the backend once to populate it.")
+
+    # Held out means not stored in any of the evaluated indexes
+    dataset = load_and_process_dataset()
+    indexed_contexts = {
+        normalize_context(metadata["user_input"])
+        for _, (_, _, metadatas) in corpora.values()
+        for metadata in metadatas
+    }
+    queries = select_held_out_queries(dataset, indexed_contexts, args.queries, args.seed)
+    if not queries:
+        raise SystemExit("No held-out queries available; every dataset question is already indexed.")
+    query_embeddings = embed_queries(queries)
+
+    rows = []
+    for name, (provider, corpus) in corpora.items():
+        print(f"{name}: corpus size {len(corpus[0])}, held-out queries {len(queries)}")
+        rows.extend(evaluate_provider(name, provider, corpus, queries, query_embeddings, args))
+
+    print_report(rows)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(rows, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
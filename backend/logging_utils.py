@@ -0,0 +1,197 @@
+"""
+Structured, non-blocking logging for the mental health chatbot
+
+Records are formatted as JSON lines on the calling thread, pushed onto a bounded
+queue and written to stderr by a background listener thread, so request handlers
+never block on stdout/stderr I/O. Per-event sampling rates and the log level can
+be changed while the server is running.
+"""
+import os
+import sys
+import json
+import math
+import time
+import queue
+import atexit
+import random
+import hashlib
+import logging
+import threading
+from logging.handlers import QueueHandler, QueueListener
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+# Comma separated "event=rate" pairs, e.g. "chat.request=0.1,chat.response=0.1"
+LOG_SAMPLE_RATES = os.getenv("LOG_SAMPLE_RATES", "")
+# Number of leading characters of user/model text to include in logs (0 = hash only)
+LOG_TEXT_PREVIEW_CHARS = int(os.getenv("LOG_TEXT_PREVIEW_CHARS", "0"))
+# Maximum length of any other string field (error messages, ids, ...)
+LOG_FIELD_MAX_CHARS = int(os.getenv("LOG_FIELD_MAX_CHARS", "200"))
+
+ROOT_LOGGER_NAME = "chatbot"
+
+_sample_rates = {}
+_listener = None
+_queue_handler = None
+_configure_lock = threading.Lock()
+
+
+def _validate_rate(rate):
+    """Convert a sampling rate to a float clamped to 0.0 - 1.0, rejecting NaN and infinities"""
+    rate = float(rate)
+    if not math.isfinite(rate):
+        raise ValueError(f"Sample rate must be a finite number, got {rate}")
+    return min(max(rate, 0.0), 1.0)
+
+
+def _parse_sample_rates(spec):
+    """Parse an "event=rate,event=rate" string into a dict, skipping invalid entries"""
+    rates = {}
+    for pair in spec.split(","):
+        if "=" not in pair:
+            continue
+        event, rate = pair.split("=", 1)
+        try:
+            rates[event.strip()] = _validate_rate(rate)
+        except ValueError:
+            continue
+    return rates
+
+
+class JsonFormatter(logging.Formatter):
+    """Format a log record as a single JSON object"""
+
+    def format(self, record):
+        payload = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "event": getattr(record, "event", None) or record.getMessage(),
+        }
+        fields = getattr(record, "fields", None)
+        if fields:
+            payload.update(fields)
+        if record.exc_info:
+            payload["exc"] = truncate(self.formatException(record.exc_info), LOG_FIELD_MAX_CHARS * 10)
+        return json.dumps(payload, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """Drop a fraction of records per event; warnings and errors are always kept"""
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = _sample_rates.get(getattr(record, "event", None), 1.0)
+        if rate >= 1.0:
+            return True
+        if random.random() < rate:
+            record.fields = dict(getattr(record, "fields", None) or {}, sample_rate=rate)
+            return True
+        return False
+
+
+class DroppingQueueHandler(QueueHandler):
+    """Queue handler that drops records instead of blocking when the queue is full"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def configure_logging():
+    """Attach the queue-backed JSON handler to the application logger (idempotent)"""
+    global _listener, _queue_handler
+
+    with _configure_lock:
+        if _listener is not None:
+            return _queue_handler
+
+        _sample_rates.update(_parse_sample_rates(LOG_SAMPLE_RATES))
+
+        log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+        _queue_handler = DroppingQueueHandler(log_queue)
+        _queue_handler.setFormatter(JsonFormatter())
+        _queue_handler.addFilter(SamplingFilter())
+
+        _listener = QueueListener(log_queue, logging.StreamHandler(sys.stderr))
+        _listener.start()
+        atexit.register(_listener.stop)
+
+        root = logging.getLogger(ROOT_LOGGER_NAME)
+        root.addHandler(_queue_handler)
+        root.setLevel(LOG_LEVEL)
+        root.propagate = False
+        return _queue_handler
+
+
+def get_logger(name=None):
+    """Return a logger under the application namespace, configuring logging on first use"""
+    configure_logging()
+    if not name:
+        return logging.getLogger(ROOT_LOGGER_NAME)
+    return logging.getLogger(f"{ROOT_LOGGER_NAME}.{name}")
+
+
+def log_event(logger, event, level=logging.INFO, exc_info=False, **fields):
+    """Log a structured event with arbitrary key/value fields"""
+    if not logger.isEnabledFor(level):
+        return
+    logger.log(level, event, exc_info=exc_info, extra={"event": event, "fields": fields})
+
+
+def set_log_level(level, name=None):
+    """Change the level of the application logger (or one of its children) at runtime"""
+    logger = get_logger(name)
+    logger.setLevel(level.upper() if isinstance(level, str) else level)
+    return logging.getLevelName(logger.getEffectiveLevel())
+
+
+def set_sample_rate(event, rate):
+    """Change the sampling rate (0.0 - 1.0) of an event at runtime"""
+    _sample_rates[event] = _validate_rate(rate)
+
+
+def get_logging_config():
+    """Return the current logging configuration"""
+    configure_logging()
+    return {
+        "level": logging.getLevelName(get_logger().getEffectiveLevel()),
+        "sample_rates": dict(_sample_rates),
+        "dropped": _queue_handler.dropped,
+    }
+
+
+def truncate(value, max_chars=None):
+    """Limit a string field to max_chars characters"""
+    max_chars = LOG_FIELD_MAX_CHARS if max_chars is None else max_chars
+    value = str(value)
+    if len(value) <= max_chars:
+        return value
+    return value[:max_chars] + "..."
+
+
+def text_fields(text, prefix="text"):
+    """Describe free text by its length and hash instead of its content"""
+    text = text or ""
+    fields = {
+        f"{prefix}_len": len(text),
+        f"{prefix}_sha256": hashlib.sha256(text.encode("utf-8")).hexdigest()[:16],
+    }
+    if LOG_TEXT_PREVIEW_CHARS > 0:
+        fields[f"{prefix}_preview"] = truncate(text, LOG_TEXT_PREVIEW_CHARS)
+    return fields
+
+
+def elapsed_ms(start):
+    """Milliseconds elapsed since a time.perf_counter() value"""
+    return round((time.perf_counter() - start) * 1000, 1)
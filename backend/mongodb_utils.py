@@ -2,13 +2,19 @@
 MongoDB implementation of the database provider
 """
 import os
+import logging
 from pymongo import MongoClient
 from db_provider import DatabaseProvider
+from logging_utils import get_logger, log_event, truncate
 from dotenv import load_dotenv
 
 # Load environment variables
 load_dotenv()
 MONGODB_URI = os.getenv("MONGODB_URI")
+# Candidates considered by the ANN search before returning the top results
+MONGODB_NUM_CANDIDATES = int(os.getenv("MONGODB_NUM_CANDIDATES", "100"))
+
+logger = get_logger("mongodb")
 
 
 class MongoDBProvider(DatabaseProvider):
@@ -18,6 +24,8 @@ class MongoDBProvider(DatabaseProvider):
         self.client = None
         self.db = None
         self.collection = None
+        self.num_candidates = MONGODB_NUM_CANDIDATES
+        self._partition_counts = {}
 
     def initialize(self):
         """Initialize the MongoDB client"""
@@ -34,7 +42,7 @@ class MongoDBProvider(DatabaseProvider):
             self.initialize()
 
         self.collection = self.db.conversations
-        print("Using MongoDB collection")
+        log_event(logger, "mongodb.collection", logging.DEBUG)
         return self.collection
 
     def collection_count(self):
@@ -55,35 +63,45 @@ class MongoDBProvider(DatabaseProvider):
                 "_id": ids[i],
                 "embedding": embeddings[i],
                 "user_input": metadatas[i]["user_input"],
-                "expert_response": metadatas[i]["expert_response"]
+                "expert_response": metadatas[i]["expert_response"],
+                "expert_responses": metadatas[i].get("expert_responses", []),
+                "issues": metadatas[i].get("issues", [])
             }
             documents.append(document)
 
         # Insert all documents
         if documents:
             self.collection.insert_many(documents)
+            self._partition_counts.clear()
 
-    def search_similar(self, query_embedding, top_k=3):
+    def search_similar(self, query_embedding, top_k=3, issue=None):
         """Search for similar documents using vector similarity"""
         if self.collection is None:
             self.get_collection()
 
         # Perform vector search
         # Note: This requires a vector search index to be set up in MongoDB Atlas
+        vector_search = {
+            "index": "conversation_vector_index",
+            "queryVector": query_embedding,
+            "path": "embedding",
+            "numCandidates": max(self.num_candidates, top_k),
+            "limit": top_k
+        }
+        if issue:
+            # Pre-filter to the issue partition; `issues` must be a filter field of the index
+            vector_search["filter"] = {"issues": {"$in": [issue]}}
+
         pipeline = [
             {
-                "$vectorSearch": {
-                    "index": "conversation_vector_index",
-                    "queryVector": query_embedding,
-                    "path": "embedding",
-                    "numCandidates": 100,
-                    "limit": top_k
-                }
+                "$vectorSearch": vector_search
             },
             {
                 "$project": {
+                    "id": "$_id",
                     "user_input": 1,
                     "expert_response": 1,
+                    "expert_responses": 1,
                     "score": {"$meta": "vectorSearchScore"}
                 }
             }
@@ -93,5 +111,34 @@ class MongoDBProvider(DatabaseProvider):
             results = list(self.collection.aggregate(pipeline))
             return results
         except Exception as e:
-            print(f"MongoDB vector search error: {e}")
-            return []
\ No newline at end of file
+            log_event(logger, "mongodb.search_error", logging.WARNING, error=truncate(e))
+            return []
+
+    def partition_count(self, issue):
+        """Return the number of documents tagged with an issue"""
+        if self.collection is None:
+            self.get_collection()
+
+        if issue not in self._partition_counts:
+            self._partition_counts[issue] = self.collection.count_documents({"issues": issue})
+        return self._partition_counts[issue]
+
+    def get_all_embeddings(self):
+        """Return the ids, embedding vectors and metadata of every document in the collection"""
+        if self.collection is None:
+            self.get_collection()
+
+        ids = []
+        embeddings = []
+        metadatas = []
+        projection = {"embedding": 1, "user_input": 1, "expert_response": 1, "expert_responses": 1, "issues": 1}
+        for document in self.collection.find({}, projection):
+            ids.append(document["_id"])
+            embeddings.append(document["embedding"])
+            metadatas.append({
+                "user_input": document["user_input"],
+                "expert_response": document["expert_response"],
+                "expert_responses": document.get("expert_responses", []),
+                "issues": document.get("issues", [])
+            })
+        return ids, embeddings, metadatas
@@ -0,0 +1,233 @@
+"""
+On-demand CPU and memory profiling of the running backend
+
+CPU profiles are time-boxed: while a capture is running, the Python stacks of
+threads that are handling requests are sampled periodically (collapsed-stack
+output for flamegraph tools), or each request is run under cProfile and the
+results are merged (pstats output). On Python 3.12+ only one cProfile can be
+active at a time, so requests that overlap a profiled one are skipped; the
+number of profiled and skipped requests is returned with every capture.
+Memory profiling diffs tracemalloc snapshots taken at two points in time.
+"""
+import io
+import os
+import math
+import sys
+import time
+import marshal
+import pstats
+import cProfile
+import threading
+import tracemalloc
+from collections import Counter
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", "60"))
+# How long a pstats capture waits for requests that were still running when it ended
+PROFILE_GRACE_SECONDS = float(os.getenv("PROFILE_GRACE_SECONDS", "5"))
+PROFILE_FORMATS = ("collapsed", "pstats", "text")
+
+_capture_lock = threading.Lock()
+_state_lock = threading.Lock()
+_request_threads = set()
+_cprofile_enabled = False
+_request_profiles = []
+_inflight_profiles = 0
+_skipped_profiles = 0
+_memory_baseline = None
+
+
+def request_started():
+    """Register the current thread as handling a request; returns a cProfile.Profile if one was started"""
+    global _inflight_profiles, _skipped_profiles
+
+    with _state_lock:
+        _request_threads.add(threading.get_ident())
+        if not _cprofile_enabled:
+            return None
+        _inflight_profiles += 1
+
+    profile = cProfile.Profile()
+    try:
+        profile.enable()
+    except ValueError:
+        # Python 3.12+ allows only one active profiler at a time
+        profile = None
+    if profile is None:
+        with _state_lock:
+            _inflight_profiles -= 1
+            _skipped_profiles += 1
+    return profile
+
+
+def request_finished(profile=None):
+    """Unregister the current thread and keep its profile if one was running"""
+    global _inflight_profiles
+
+    if profile is not None:
+        profile.disable()
+    with _state_lock:
+        _request_threads.discard(threading.get_ident())
+        if profile is not None:
+            _inflight_profiles -= 1
+            _request_profiles.append(profile)
+
+
+def _frame_label(frame):
+    """Label a stack frame as function (file:line)"""
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def _sample_request_stacks(seconds, interval):
+    """Periodically record the stacks of request threads, returning collapsed-stack counts"""
+    counts = Counter()
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        with _state_lock:
+            threads = set(_request_threads)
+        if threads:
+            for ident, frame in sys._current_frames().items():
+                if ident not in threads:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_label(frame))
+                    frame = frame.f_back
+                counts[";".join(reversed(stack))] += 1
+        time.sleep(interval)
+    return counts
+
+
+def _collect_request_profiles(seconds):
+    """Run every request under cProfile for the given time; returns (merged stats, coverage info)"""
+    global _cprofile_enabled, _skipped_profiles
+
+    with _state_lock:
+        _request_profiles.clear()
+        _skipped_profiles = 0
+        _cprofile_enabled = True
+    try:
+        time.sleep(seconds)
+    finally:
+        with _state_lock:
+            _cprofile_enabled = False
+
+    # Let requests that started inside the window finish so their profiles are included
+    deadline = time.monotonic() + PROFILE_GRACE_SECONDS
+    while _inflight_profiles > 0 and time.monotonic() < deadline:
+        time.sleep(0.05)
+
+    with _state_lock:
+        profiles = list(_request_profiles)
+        _request_profiles.clear()
+        info = {
+            "profiled_requests": len(profiles),
+            "skipped_requests": _skipped_profiles,
+            "unfinished_requests": _inflight_profiles,
+        }
+
+    stats = pstats.Stats()
+    if profiles:
+        stats.add(*profiles)
+    return stats, info
+
+
+def _finite_number(value, name):
+    """Convert a parameter to a float, rejecting NaN and infinities"""
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"{name} must be a number, got {value!r}")
+    if not math.isfinite(number):
+        raise ValueError(f"{name} must be a finite number, got {value!r}")
+    return number
+
+
+def capture_cpu_profile(seconds, interval_ms=5, fmt="collapsed", limit=50):
+    """Profile live request handling for a number of seconds; returns (body, mimetype, info)"""
+    # Validate everything up front so a bad parameter cannot hold the capture for its full duration
+    if fmt not in PROFILE_FORMATS:
+        raise ValueError(f"Unknown profile format '{fmt}', expected one of {', '.join(PROFILE_FORMATS)}")
+    seconds = min(max(_finite_number(seconds, "seconds"), 0.1), PROFILE_MAX_SECONDS)
+    interval = max(_finite_number(interval_ms, "interval_ms"), 1.0) / 1000
+    try:
+        limit = int(limit)
+    except (TypeError, ValueError):
+        raise ValueError(f"limit must be an integer, got {limit!r}")
+    if limit < 1:
+        raise ValueError(f"limit must be at least 1, got {limit}")
+
+    if not _capture_lock.acquire(blocking=False):
+        raise RuntimeError("A CPU profile is already being captured")
+    try:
+        if fmt == "collapsed":
+            counts = _sample_request_stacks(seconds, interval)
+            body = "".join(f"{stack} {count}\n" for stack, count in counts.most_common())
+            return body, "text/plain", {"samples": sum(counts.values())}
+
+        stats, info = _collect_request_profiles(seconds)
+        if fmt == "pstats":
+            # Same layout as pstats.Stats.dump_stats, loadable with pstats/snakeviz
+            return marshal.dumps(stats.stats), "application/octet-stream", info
+
+        stream = io.StringIO()
+        stream.write(
+            f"Profiled requests: {info['profiled_requests']}, "
+            f"skipped (another profiler was active): {info['skipped_requests']}, "
+            f"unfinished: {info['unfinished_requests']}\n"
+        )
+        stats.stream = stream
+        stats.sort_stats("cumulative").print_stats(limit)
+        return stream.getvalue(), "text/plain", info
+    finally:
+        _capture_lock.release()
+
+
+def start_memory_tracing(frames=10):
+    """Start tracemalloc (if needed) and take the baseline snapshot"""
+    global _memory_baseline
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(int(frames))
+    _memory_baseline = tracemalloc.take_snapshot()
+    return memory_status()
+
+
+def memory_snapshot_diff(limit=25, reset=False, group_by="traceback"):
+    """Compare a new snapshot with the baseline and return the largest allocation changes"""
+    global _memory_baseline
+    if not tracemalloc.is_tracing() or _memory_baseline is None:
+        raise RuntimeError("Memory tracing is not running")
+
+    snapshot = tracemalloc.take_snapshot()
+    differences = snapshot.compare_to(_memory_baseline, group_by)
+    top = []
+    for diff in differences[:int(limit)]:
+        top.append({
+            "size_diff": diff.size_diff,
+            "size": diff.size,
+            "count_diff": diff.count_diff,
+            "count": diff.count,
+            "traceback": diff.traceback.format()
+        })
+    if reset:
+        _memory_baseline = snapshot
+    return dict(memory_status(), differences=top)
+
+
+def stop_memory_tracing():
+    """Stop tracemalloc and discard the baseline"""
+    global _memory_baseline
+    _memory_baseline = None
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+    return memory_status()
+
+
+def memory_status():
+    """Return whether tracemalloc is running and the traced memory totals"""
+    tracing = tracemalloc.is_tracing()
+    current, peak = tracemalloc.get_traced_memory() if tracing else (0, 0)
+    return {"tracing": tracing, "traced_current": current, "traced_peak": peak}
@@ -2,12 +2,23 @@
 RAG utilities for mental health chatbot
 """
 import os
+import re
 import uuid
 import time
+import logging
 import google.generativeai as genai
 from datasets import load_dataset
 from dotenv import load_dotenv
 from db_provider import get_db_provider
+from logging_utils import get_logger, log_event, truncate
+from embedding_utils import EmbeddingBatcher, affects_whole_batch
+from scheduler_utils import (
+    model_scheduler,
+    request_options,
+    PRIORITY_CHAT,
+    PRIORITY_BACKGROUND,
+    KIND_EMBEDDING
+)
 
 # Load environment variables
 load_dotenv()
@@ -16,32 +27,110 @@ GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
 genai.configure(api_key=GOOGLE_API_KEY)
 # Use embedding-001 model as it has higher quota limits
 EMBEDDING_MODEL_ID = "models/embedding-001"
+# Number of example conversations retrieved per user message
+RAG_TOP_K = int(os.getenv("RAG_TOP_K", "3"))
+# Number of expert answers shown for each retrieved question
+RAG_RESPONSES_PER_EXAMPLE = int(os.getenv("RAG_RESPONSES_PER_EXAMPLE", "1"))
+# Issue partitions smaller than this fall back to searching the full index
+RAG_MIN_PARTITION_SIZE = int(os.getenv("RAG_MIN_PARTITION_SIZE", "20"))
+# Unique questions embedded when the database is first populated (0 = the whole dataset)
+RAG_MAX_INGEST_QUESTIONS = int(os.getenv("RAG_MAX_INGEST_QUESTIONS", "100"))
+# Questions sent in one embedding call during ingestion
+RAG_INGEST_BATCH_SIZE = int(os.getenv("RAG_INGEST_BATCH_SIZE", "20"))
+
+# Whole-word patterns (with their inflected forms) used to tag dataset questions with the
+# specialist issues they relate to. Keys match the specialist bots in SPECIALIST_PROMPTS (app.py).
+ISSUE_KEYWORDS = {
+    "anxiety": (
+        r"anxi(?:ety|eties|ous|ously)", r"panic(?:s|ked|king|ky)?", r"worr(?:y|ies|ied|ying|isome)",
+        r"nervous(?:ness|ly)?", r"fears?", r"fear(?:ed|ing|ful)", r"phobi(?:a|as|c)",
+        r"overthink(?:s|ing)?", r"overthought",
+    ),
+    "depression": (
+        r"depress(?:ed|ing|ion|ions|ive)?", r"sad(?:ness|ly|der|dest)?", r"hopeless(?:ness|ly)?",
+        r"worthless(?:ness)?", r"suicid(?:e|es|al|ality)", r"lonel(?:y|ier|iness)", r"empty", r"emptiness",
+        r"numb(?:ness|ed)?", r"grief", r"griev(?:e|es|ed|ing)",
+    ),
+    "stress": (
+        r"stress(?:es|ed|ful|ing|or|ors)?", r"overwhelm(?:s|ed|ing)?", r"pressured?", r"pressures",
+        r"burnout", r"burn(?:ed|t) out", r"exhaust(?:ed|ing|ion)", r"tense", r"tension",
+        r"workloads?", r"deadlines?",
+    ),
+}
+ISSUE_PATTERNS = {
+    issue: re.compile(r"\b(?:" + "|".join(keywords) + r")\b", re.IGNORECASE)
+    for issue, keywords in ISSUE_KEYWORDS.items()
+}
 
 # Initialize the database provider
 db_provider = get_db_provider()
 
+logger = get_logger("rag")
+
 def create_embeddings_batch(texts):
-    """Create embedding vector for a text using the Gemini embedding model"""
+    """Create embedding vectors for texts using the Gemini embedding model, logging and re-raising failures"""
     if not texts:
-        return None
+        return []
     try:
-        result = genai.embed_content(EMBEDDING_MODEL_ID, texts)
+        result = model_scheduler.call(
+            genai.embed_content, EMBEDDING_MODEL_ID, texts,
+            priority=PRIORITY_BACKGROUND, session_id="ingestion", kind=KIND_EMBEDDING,
+            request_options=request_options()
+        )
         embeddings = result["embedding"]
         return embeddings
     except Exception as e:
-        print(f"Error generating embeddings batch: {e}")
-        if "token limit" in str(e).lower():
-            print("Potential token limit error detected in embedding request despite pre-truncation attempts.")
-        print(f"Failed to embed batch of size {len(texts)}. Returning empty embeddings for this batch.")
-        return [None] * len(texts)
+        log_event(
+            logger, "embedding.error", logging.WARNING,
+            error=truncate(e),
+            token_limit="token limit" in str(e).lower(),
+            batch_size=len(texts)
+        )
+        raise
+
+
+def embed_texts(texts, priority=PRIORITY_CHAT):
+    """Embed a list of texts in a single API call, raising on failure"""
+    result = model_scheduler.call(
+        genai.embed_content, EMBEDDING_MODEL_ID, list(texts),
+        priority=priority, session_id="query_embeddings", kind=KIND_EMBEDDING,
+        request_options=request_options()
+    )
+    return result["embedding"]
+
+
+# Concurrent user queries share batched embedding calls
+query_batcher = EmbeddingBatcher(embed_texts)
 
 
 def load_and_process_dataset():
     """Load the mental health counseling dataset from Hugging Face"""
     dataset = load_dataset("Amod/mental_health_counseling_conversations")
-    print(f"Dataset loaded. Number of conversations: {len(dataset['train'])}")
+    log_event(logger, "dataset.loaded", conversations=len(dataset['train']))
     return dataset
 
+def normalize_context(text):
+    """Normalize a question for duplicate detection (case and whitespace insensitive)"""
+    return " ".join((text or "").split()).lower()
+
+def group_by_context(rows):
+    """Group dataset rows by normalized context, keeping first-seen order and distinct responses"""
+    groups = {}
+    for item in rows:
+        key = normalize_context(item['Context'])
+        if not key:
+            continue
+        group = groups.setdefault(key, {"user_input": item['Context'], "expert_responses": [], "rows": 0})
+        group["rows"] += 1
+        response = item['Response']
+        if response and response not in group["expert_responses"]:
+            group["expert_responses"].append(response)
+    return [group for group in groups.values() if group["expert_responses"]]
+
+def tag_issues(text):
+    """Return the specialist issues a question mentions"""
+    return [issue for issue, pattern in ISSUE_PATTERNS.items() if pattern.search(text or "")]
+
 def populate_vector_database(dataset):
     """Process dataset and store with embeddings"""
     # Initialize the database
@@ -50,71 +139,137 @@ def populate_vector_database(dataset):
 
     # Check if collection already has data
     if db_provider.collection_count() > 0:
-        print("Collection already populated, skipping...")
+        log_event(logger, "ingest.skipped", reason="already_populated")
         return collection
 
-    print("Populating vector database...")
-    # Process each conversation pair
-    ids = []
-    embeddings = []
-    metadatas = []
+    log_event(logger, "ingest.start")
+
+    # Pre-pass: the same question appears many times with different answers,
+    # so embed each unique question once and attach all of its answers
+    rows = len(dataset['train'])
+    groups = group_by_context(dataset['train'])
+    unique_contexts = len(groups)
 
     # Only process a subset to start with (reduce quota usage)
-    max_samples = 100  # Limit initial dataset size
+    if RAG_MAX_INGEST_QUESTIONS > 0:
+        groups = groups[:RAG_MAX_INGEST_QUESTIONS]
 
     # Rate limiting counters
     request_count = 0
+    retry_count = 0
     batch_size = 7  # Number of requests before longer pause
+    contexts_per_request = max(1, RAG_INGEST_BATCH_SIZE)
 
-    for idx, item in enumerate(dataset['train']):  # Process limited number of samples
-        user_input = item['Context']
-        expert_response = item['Response']
-
-        # Create combined text for embedding (only user input for efficiency)
-        combined_text = user_input
-
-        # Generate a unique ID
-        doc_id = str(uuid.uuid4())
-
-        # print(f"Generating embedding {idx+1}/{max_samples}...")
-
+    def embed_with_rate_limit(texts):
+        nonlocal request_count
         # Rate limiting - short pause between each request
         if request_count > 0:
             time.sleep(0.5)  # Half second pause between embeddings
 
         # Additional longer pause after each batch
         if request_count % batch_size == 0 and request_count > 0:
-            print(f"Taking a longer pause after {batch_size} requests...")
+            log_event(logger, "ingest.pause", logging.DEBUG, requests=request_count)
             time.sleep(3)  # 3 second pause after each batch
 
-        # Generate embedding with rate limiting
-        embedding = create_embeddings_batch(combined_text)
         request_count += 1
+        return create_embeddings_batch(texts)
 
-        # Store data for batch addition
-        ids.append(doc_id)
-        embeddings.append(embedding)
-        metadatas.append({
-            "user_input": user_input,
-            "expert_response": expert_response
-        })
-
-        # Add in smaller batches to reduce memory usage
-        if len(ids) >= 100 or idx == min(len(dataset['train']) - 1, max_samples - 1):
-            db_provider.add_embeddings(ids, embeddings, metadatas)
-
-            # Clear the lists
-            ids = []
-            embeddings = []
-            metadatas = []
-
-            print(f"Processed {idx + 1} documents")
-
-    print(f"Database populated with {db_provider.collection_count()} documents")
+    def embed_individually(texts):
+        nonlocal retry_count
+        embeddings = []
+        for text in texts:
+            retry_count += 1
+            try:
+                embeddings.append(embed_with_rate_limit([text])[0])
+            except Exception as e:
+                embeddings.append(None)
+                if affects_whole_batch(e):
+                    # Rate limited or shed: the remaining questions would fail the same way
+                    break
+        return embeddings + [None] * (len(texts) - len(embeddings))
+
+    stored = 0
+    failed = 0
+    dimensions = 0
+    partition_sizes = {issue: 0 for issue in ISSUE_KEYWORDS}
+    for start in range(0, len(groups), contexts_per_request):
+        chunk = groups[start:start + contexts_per_request]
+
+        # Generate embeddings with rate limiting
+        texts = [group["user_input"] for group in chunk]
+        try:
+            embeddings = embed_with_rate_limit(texts)
+        except Exception as e:
+            if len(chunk) > 1 and not affects_whole_batch(e):
+                # One bad question (e.g. over the token limit) must not drop the whole chunk
+                log_event(logger, "ingest.batch_retry", logging.WARNING, size=len(chunk))
+                embeddings = embed_individually(texts)
+            else:
+                embeddings = [None] * len(chunk)
+
+        ids = []
+        vectors = []
+        metadatas = []
+        for group, embedding in zip(chunk, embeddings):
+            # Skip questions whose embedding failed
+            if embedding is None:
+                failed += 1
+                continue
+            dimensions = len(embedding)
+            issues = tag_issues(group["user_input"])
+            for issue in issues:
+                partition_sizes[issue] += 1
+            ids.append(str(uuid.uuid4()))
+            vectors.append(embedding)
+            metadatas.append({
+                "user_input": group["user_input"],
+                "expert_response": group["expert_responses"][0],
+                "expert_responses": group["expert_responses"],
+                "issues": issues
+            })
+
+        if ids:
+            db_provider.add_embeddings(ids, vectors, metadatas)
+            stored += len(ids)
+        log_event(logger, "ingest.progress", processed=start + len(chunk))
+
+    # Deduplication savings compare one embedding/vector per unique question with one per row;
+    # batching savings compare one call per unique question with the calls actually made
+    # (retries of failed chunks included, so it never goes below zero)
+    ingested_rows = sum(group["rows"] for group in groups)
+    duplicates = ingested_rows - len(groups)
+    log_event(
+        logger, "ingest.dedup",
+        dataset_rows=rows,
+        unique_contexts=unique_contexts,
+        ingested_rows=ingested_rows,
+        ingested_contexts=len(groups),
+        dedup_embeddings_saved=duplicates,
+        vectors_stored=stored,
+        vectors_failed=failed,
+        vectors_saved=duplicates,
+        index_bytes_saved=duplicates * dimensions * 4,
+        embedding_calls=request_count,
+        retry_calls=retry_count,
+        batching_calls_saved=max(0, len(groups) - request_count)
+    )
+    log_event(logger, "ingest.partitions", **partition_sizes)
+    log_event(logger, "ingest.done", documents=db_provider.collection_count())
     return collection
 
-def retrieve_relevant_conversations(query, top_k=3):
-    """Retrieve the most relevant conversations for a user query"""
+def search_partition(query_embedding, top_k, issue=None):
+    """Search the issue's partition, or the full index if the partition is unknown or too sparse"""
+    if issue in ISSUE_KEYWORDS:
+        size = db_provider.partition_count(issue)
+        if size >= max(top_k, RAG_MIN_PARTITION_SIZE):
+            results = db_provider.search_similar(query_embedding, top_k, issue=issue)
+            if len(results) >= top_k:
+                return results
+        log_event(logger, "retrieve.partition_fallback", logging.DEBUG, issue=issue, partition_size=size)
+    return db_provider.search_similar(query_embedding, top_k)
+
+def retrieve_relevant_conversations(query, top_k=RAG_TOP_K, issue=None):
+    """Retrieve the most relevant conversations for a user query, preferring the issue's partition"""
     # Initialize the database if not already initialized
     db_provider.initialize()
     collection = db_provider.get_collection()
@@ -126,35 +281,48 @@ def retrieve_relevant_conversations(query, top_k=3):
 
         while retry_count < max_retries:
             try:
-                query_embedding = create_embeddings_batch(query)
+                query_embedding = query_batcher.embed(query)
                 break
             except Exception as e:
                 retry_count += 1
                 if "429" in str(e) and retry_count < max_retries:
                     # If rate limited, wait longer before retry
-                    print(f"Rate limited, pausing for {retry_count * 5} seconds...")
+                    log_event(logger, "embedding.rate_limited", logging.WARNING, pause_s=retry_count * 5)
                     time.sleep(retry_count * 5)
                 else:
                     if retry_count >= max_retries:
-                        print(f"Failed after {max_retries} retries: {e}")
+                        log_event(logger, "embedding.retries_exhausted", logging.ERROR, retries=max_retries, error=truncate(e))
                         return []
                     raise e
 
         # Perform vector search using the provider
-        return db_provider.search_similar(query_embedding, top_k)
+        return search_partition(query_embedding, top_k, issue)
 
     except Exception as e:
-        print(f"Error in retrieve_relevant_conversations: {e}")
+        log_event(logger, "retrieve.error", logging.WARNING, error=truncate(e))
         # Return empty results if there's an error
         return []
 
+def get_embedding_stats():
+    """Return batch-size and queueing-delay statistics for query embeddings"""
+    return query_batcher.stats()
+
+def select_responses(example, count=RAG_RESPONSES_PER_EXAMPLE):
+    """Pick expert answers from a retrieved question's group of answers"""
+    # Documents stored before deduplication only have a single expert_response
+    responses = example.get("expert_responses") or [example["expert_response"]]
+    return responses[:max(1, count)]
+
 def augment_prompt_with_rag(user_message, relevant_examples):
     """Augment the prompt with RAG context"""
 
     # Format the retrieved examples
     examples_text = ""
     for example in relevant_examples:
-        examples_text += f"User: {example['user_input']}\nExpert: {example['expert_response']}\n\n"
+        examples_text += f"User: {example['user_input']}\n"
+        for response in select_responses(example):
+            examples_text += f"Expert: {response}\n"
+        examples_text += "\n"
 
     augmented_prompt = f"""
 Here are some examples of professional conversations to use as guidance:
@@ -176,11 +344,10 @@ def initialize_rag_database():
     try:
         dataset = load_and_process_dataset()
         populate_vector_database(dataset)
-        print("RAG database initialized successfully")
+        log_event(logger, "rag.initialized")
         return True
     except Exception as e:
-        print(f"Error initializing RAG database: {e}")
-        print("Continuing without RAG support...")
+        log_event(logger, "rag.init_failed", logging.ERROR, error=truncate(e), fallback="no_rag")
         return False
 
 # Legacy functions for compatibility
@@ -188,12 +355,12 @@ def get_chroma_client():
     """Compatibility function - now handled by db_provider"""
     # Initialize the DB provider
     db_provider.initialize()
-    print("Using abstracted database provider instead of direct ChromaDB access")
+    log_event(logger, "rag.legacy_call", logging.DEBUG)
     return None
 
 def get_or_create_collection(client):
     """Compatibility function - now handled by db_provider"""
     # Get the collection via the provider
     collection = db_provider.get_collection()
-    print("Using abstracted database provider instead of direct ChromaDB access")
+    log_event(logger, "rag.legacy_call", logging.DEBUG)
     return collection
\ No newline at end of file
@@ -0,0 +1,230 @@
+"""
+Fair-share scheduling and admission control for outbound Gemini calls
+
+Every model call goes through a single scheduler that caps how many calls run at
+once. Waiting calls are served by priority (live chat, then intro generation,
+then background ingestion) and round-robin across sessions within a priority,
+so one busy session cannot starve the others. Calls whose expected queue wait
+exceeds their priority's limit are rejected with SchedulerOverloaded straight
+away; calls that were queued are rejected once their actual wait reaches the
+limit. Either way the caller replies with a degraded answer instead of piling up
+429s.
+Callers pass request_options() to the Gemini client so a hung call times out
+and always gives its slot back.
+"""
+import os
+import time
+import logging
+import threading
+from collections import Counter, OrderedDict, deque
+from dotenv import load_dotenv
+from logging_utils import get_logger, log_event
+
+# Load environment variables
+load_dotenv()
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "4"))
+# Longest queue wait (seconds) before a call is shed; background work is never shed
+GEMINI_CHAT_MAX_WAIT_S = float(os.getenv("GEMINI_CHAT_MAX_WAIT_S", "8"))
+GEMINI_INIT_MAX_WAIT_S = float(os.getenv("GEMINI_INIT_MAX_WAIT_S", "3"))
+# Timeout (seconds) of each Gemini API request
+GEMINI_REQUEST_TIMEOUT_S = float(os.getenv("GEMINI_REQUEST_TIMEOUT_S", "30"))
+
+# Lower value = served first
+PRIORITY_CHAT = 0
+PRIORITY_INIT = 1
+PRIORITY_BACKGROUND = 2
+PRIORITY_NAMES = {PRIORITY_CHAT: "chat", PRIORITY_INIT: "init", PRIORITY_BACKGROUND: "background"}
+
+MAX_WAIT_S = {
+    PRIORITY_CHAT: GEMINI_CHAT_MAX_WAIT_S,
+    PRIORITY_INIT: GEMINI_INIT_MAX_WAIT_S,
+    PRIORITY_BACKGROUND: None,
+}
+
+# Kinds of model call; each has its own measured duration
+KIND_CHAT = "chat"
+KIND_EMBEDDING = "embedding"
+
+# Assumed duration of a model call until real measurements are available
+DEFAULT_SERVICE_TIME_S = {KIND_CHAT: 2.0, KIND_EMBEDDING: 0.5}
+
+logger = get_logger("scheduler")
+
+
+class SchedulerOverloaded(Exception):
+    """Raised when a call is shed because its queue wait would exceed the limit"""
+
+    def __init__(self, priority, expected_wait_s):
+        self.priority = priority
+        self.expected_wait_s = expected_wait_s
+        super().__init__(
+            f"Model call queue is full ({PRIORITY_NAMES.get(priority, priority)} call, "
+            f"expected wait {expected_wait_s:.1f}s)"
+        )
+
+
+def request_options():
+    """Options for Gemini client calls made through the scheduler"""
+    return {"timeout": GEMINI_REQUEST_TIMEOUT_S}
+
+
+class _Ticket:
+    """A call waiting for a slot"""
+
+    __slots__ = ("priority", "session_id", "kind", "enqueued", "granted")
+
+    def __init__(self, priority, session_id, kind):
+        self.priority = priority
+        self.session_id = session_id
+        self.kind = kind
+        self.enqueued = time.monotonic()
+        self.granted = False
+
+
+class ModelCallScheduler:
+    """Priority + per-session round-robin scheduler with a global concurrency cap"""
+
+    def __init__(self, max_concurrency=GEMINI_MAX_CONCURRENCY, max_wait_s=None):
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_wait_s = dict(MAX_WAIT_S if max_wait_s is None else max_wait_s)
+        self._cond = threading.Condition()
+        self._running = 0
+        self._running_kinds = Counter()
+        # priority -> OrderedDict(session_id -> deque of tickets); session order is the round-robin order
+        self._queues = {priority: OrderedDict() for priority in PRIORITY_NAMES}
+        # priority -> number of waiting tickets per call kind
+        self._waiting = {priority: Counter() for priority in PRIORITY_NAMES}
+        self._service_time_s = dict(DEFAULT_SERVICE_TIME_S)
+        self._completed = 0
+        self._shed = {priority: 0 for priority in PRIORITY_NAMES}
+
+    def call(self, fn, *args, priority=PRIORITY_CHAT, session_id=None, kind=KIND_CHAT, **kwargs):
+        """Run fn(*args, **kwargs) once a slot is available"""
+        self._acquire(priority, session_id, kind)
+        start = time.monotonic()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            self._release(kind, time.monotonic() - start)
+
+    def _service_time(self, kind):
+        """Average duration of a call of the given kind"""
+        return self._service_time_s.get(kind, DEFAULT_SERVICE_TIME_S[KIND_CHAT])
+
+    def _expected_wait(self, priority):
+        """Estimate the queue wait for a new call of the given priority"""
+        ahead = Counter()
+        for p, kinds in self._waiting.items():
+            if p <= priority:
+                ahead.update(kinds)
+        free_slots = self.max_concurrency - self._running
+        if sum(ahead.values()) < free_slots:
+            return 0.0
+        # Work queued ahead plus the remaining half (on average) of running calls,
+        # shared across all slots
+        work = sum(self._service_time(kind) * count for kind, count in ahead.items())
+        work += sum(self._service_time(kind) * count for kind, count in self._running_kinds.items()) / 2
+        return work / self.max_concurrency
+
+    def _shed_call(self, priority, expected_wait):
+        self._shed[priority] += 1
+        log_event(logger, "scheduler.shed", logging.WARNING,
+                  priority=PRIORITY_NAMES.get(priority, priority),
+                  expected_wait_s=round(expected_wait, 2),
+                  running=self._running,
+                  waiting=sum(sum(kinds.values()) for kinds in self._waiting.values()))
+        raise SchedulerOverloaded(priority, expected_wait)
+
+    def _acquire(self, priority, session_id, kind):
+        """Block until the call may run, or raise SchedulerOverloaded"""
+        max_wait = self.max_wait_s.get(priority)
+        with self._cond:
+            expected_wait = self._expected_wait(priority)
+            if max_wait is not None and expected_wait > max_wait:
+                self._shed_call(priority, expected_wait)
+
+            ticket = _Ticket(priority, session_id, kind)
+            self._queues[priority].setdefault(session_id, deque()).append(ticket)
+            self._waiting[priority][kind] += 1
+            self._dispatch()
+
+            deadline = None if max_wait is None else ticket.enqueued + max_wait
+            while not ticket.granted:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    self._remove(ticket)
+                    self._shed_call(priority, time.monotonic() - ticket.enqueued)
+                self._cond.wait(remaining)
+
+            queue_wait = time.monotonic() - ticket.enqueued
+        if queue_wait > 0.05:
+            log_event(logger, "scheduler.queued", logging.DEBUG,
+                      priority=PRIORITY_NAMES.get(priority, priority),
+                      queue_wait_ms=round(queue_wait * 1000, 1))
+
+    def _remove(self, ticket):
+        """Drop a ticket that gave up waiting"""
+        sessions = self._queues[ticket.priority]
+        tickets = sessions.get(ticket.session_id)
+        if tickets and ticket in tickets:
+            tickets.remove(ticket)
+            self._waiting[ticket.priority][ticket.kind] -= 1
+            if not tickets:
+                del sessions[ticket.session_id]
+
+    def _dispatch(self):
+        """Grant free slots to waiting tickets (must hold the lock)"""
+        granted = False
+        while self._running < self.max_concurrency:
+            ticket = self._next_ticket()
+            if ticket is None:
+                break
+            ticket.granted = True
+            self._running += 1
+            self._running_kinds[ticket.kind] += 1
+            granted = True
+        if granted:
+            self._cond.notify_all()
+
+    def _next_ticket(self):
+        """Pop the next ticket: highest priority first, round-robin over sessions"""
+        for priority in sorted(self._queues):
+            sessions = self._queues[priority]
+            if not sessions:
+                continue
+            session_id, tickets = sessions.popitem(last=False)
+            ticket = tickets.popleft()
+            if tickets:
+                # Session still has work; it goes to the back of the rotation
+                sessions[session_id] = tickets
+            self._waiting[priority][ticket.kind] -= 1
+            return ticket
+        return None
+
+    def _release(self, kind, service_time):
+        with self._cond:
+            self._running -= 1
+            self._running_kinds[kind] -= 1
+            self._completed += 1
+            # Exponentially weighted moving average of call duration, per kind
+            self._service_time_s[kind] = 0.8 * self._service_time(kind) + 0.2 * service_time
+            self._dispatch()
+
+    def stats(self):
+        """Return current load and shedding counters"""
+        with self._cond:
+            return {
+                "max_concurrency": self.max_concurrency,
+                "running": self._running,
+                "waiting": {PRIORITY_NAMES[p]: sum(kinds.values()) for p, kinds in self._waiting.items()},
+                "sessions_waiting": {PRIORITY_NAMES[p]: len(s) for p, s in self._queues.items()},
+                "completed": self._completed,
+                "shed": {PRIORITY_NAMES[p]: count for p, count in self._shed.items()},
+                "service_time_s": {kind: round(t, 3) for kind, t in self._service_time_s.items()},
+                "request_timeout_s": GEMINI_REQUEST_TIMEOUT_S,
+                "max_wait_s": {PRIORITY_NAMES[p]: wait for p, wait in self.max_wait_s.items()},
+            }
+
+
+# Shared by every module that calls the Gemini API
+model_scheduler = ModelCallScheduler()
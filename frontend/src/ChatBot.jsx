@@ -2,6 +2,17 @@ import "./styling/ChatBot.css";
 import {useEffect, useState, useRef} from "react";
 import React from "react";
 
+// Identifies this browser tab so the backend can share model calls fairly between users
+const getSessionId = () => {
+    let sessionId = sessionStorage.getItem("sessionId");
+    if (!sessionId) {
+        sessionId = crypto.randomUUID
+            ? crypto.randomUUID()
+            : `${Date.now()}-${Math.random().toString(36).slice(2)}`;
+        sessionStorage.setItem("sessionId", sessionId);
+    }
+    return sessionId;
+};
 
 function ChatBot() {
 
@@ -58,6 +69,7 @@ function ChatBot() {
                 method: 'POST',
                 headers: {
                     'Content-Type': 'application/json',
+                    'X-Session-Id': getSessionId(),
                 },
                 body: JSON.stringify({ message: newInputValue.trim() }),
             });
@@ -84,7 +96,9 @@ function ChatBot() {
         useEffect(() => {
             const initChat = async () => {
             try {
-                const response = await fetch("http://localhost:5000/api/init");
+                const response = await fetch("http://localhost:5000/api/init", {
+                    headers: { "X-Session-Id": getSessionId() },
+                });
                 if (response.ok) {
                 const data = await response.json();
                 // Add the nurse's introduction to the chat log